@@ -1,37 +1,85 @@
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse
+from typing import Any, Dict, List
+from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
 from app.services.converter_service import ConverterService
 
 router = APIRouter(tags=["converter"])
 
+# Максимальная длина HTML текста (в символах). Проверка идет уже после того, как FastAPI
+# прочитал и разобрал тело запроса, поэтому она ограничивает работу конвертера, но не память
+# на чтение тела - ее нужно ограничивать на уровне прокси/сервера
+MAX_HTML_LENGTH = 10 * 1024 * 1024
+
+# Сервис не хранит состояние между запросами, поэтому используется один экземпляр
+converter_service = ConverterService()
+
+
+def get_converter_service() -> ConverterService:
+    return converter_service
+
 
 class ConvertRequest(BaseModel):
     html_text: str
 
 
+def _build_response(message: str, markdown: str, html_with_ids: str, mappings: List[Dict[str, Any]],
+                    original_html_length: int, status: str, include_html_with_ids: bool) -> Dict[str, Any]:
+    """Собирает ответ /convert, поле html_with_ids добавляется только по запросу клиента"""
+    response = {
+        "message": message,
+        "markdown": markdown,
+    }
+    if include_html_with_ids:
+        response["html_with_ids"] = html_with_ids
+    response.update({
+        "mappings": mappings,
+        "original_html_length": original_html_length,
+        "status": status
+    })
+    return response
+
+
 @router.post("/convert")
-async def convert_html(request: ConvertRequest):
+async def convert_html(request: ConvertRequest,
+                       include_html_with_ids: bool = True,
+                       service: ConverterService = Depends(get_converter_service)):
     """
     Конвертирует HTML текст в Markdown
+    
+    При include_html_with_ids=false поле html_with_ids в ответ не попадает
     """
     if not request.html_text:
         raise HTTPException(status_code=400, detail="HTML текст не предоставлен")
     
+    if len(request.html_text) > MAX_HTML_LENGTH:
+        raise HTTPException(
+            status_code=413,
+            detail=f"HTML текст слишком большой (максимум {MAX_HTML_LENGTH} символов)"
+        )
+    
+    # Текст из одних пробельных символов конвертировать не во что
+    if not request.html_text.strip():
+        return _build_response(
+            message="HTML текст не содержит данных для конвертации",
+            markdown="",
+            html_with_ids="",
+            mappings=[],
+            original_html_length=len(request.html_text),
+            status="empty",
+            include_html_with_ids=include_html_with_ids
+        )
+    
     try:
-        converter_service = ConverterService()
-        result = await converter_service.convert_html_text(request.html_text)
+        result = await service.convert_html_text(request.html_text, include_html_with_ids)
         
-        return JSONResponse(
-            status_code=200,
-            content={
-                "message": "HTML успешно конвертирован",
-                "markdown": result.get("markdown_result", ""),
-                "html_with_ids": result.get("html_with_ids", ""),
-                "mappings": result.get("mappings", []),
-                "original_html_length": result.get("original_html_length", 0),
-                "status": result.get("status", "converted")
-            }
+        return _build_response(
+            message="HTML успешно конвертирован",
+            markdown=result.get("markdown_result", ""),
+            html_with_ids=result.get("html_with_ids", ""),
+            mappings=result.get("mappings", []),
+            original_html_length=result.get("original_html_length", 0),
+            status=result.get("status", "converted"),
+            include_html_with_ids=include_html_with_ids
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка при конвертации: {str(e)}")
\ No newline at end of file
@@ -1,4 +1,5 @@
-from typing import Dict, Any
+from typing import Dict, List, Any, Sequence
+from fastapi.concurrency import run_in_threadpool
 from app.services.mapping_service import MappingService
 
 
@@ -10,27 +11,36 @@ class ConverterService:
     def __init__(self):
         self.mapping_service = MappingService()
     
-    async def convert_html_text(self, html_text: str) -> Dict[str, Any]:
+    async def convert_html_text(self, html_text: str, include_html_with_ids: bool = True) -> Dict[str, Any]:
         """
         Конвертирует HTML текст в Markdown с созданием маппинга
         
+        Конвертация синхронная и нагружает CPU, поэтому выполняется в пуле
+        потоков, чтобы не блокировать event loop.
+        
         Args:
             html_text: HTML текст для конвертации
+            include_html_with_ids: Возвращать ли весь HTML с проставленными ID
             
         Returns:
             Dict с результатом конвертации и маппингом
         """
-        result = self.mapping_service.convert_with_mapping(html_text)
+        result = await run_in_threadpool(
+            self.mapping_service.convert_with_mapping, html_text, include_html_with_ids
+        )
         return result
     
-    async def find_html_by_line(self, line_number: int) -> Dict[str, Any]:
+    async def find_html_by_line(self, mappings: List[Dict[str, Any]], line_ends: Sequence[int],
+                                line_number: int) -> Dict[str, Any]:
         """
         Находит HTML блок по номеру строки Markdown
         
         Args:
+            mappings: Маппинг из результата convert_html_text
+            line_ends: Последние строки маппингов из результата convert_html_text
             line_number: Номер строки в Markdown документе
             
         Returns:
             Dict с информацией о HTML блоке
         """
-        return self.mapping_service.find_html_by_line(line_number)
\ No newline at end of file
+        return self.mapping_service.find_html_by_line(mappings, line_ends, line_number)
\ No newline at end of file
@@ -1,154 +1,383 @@
-from typing import Dict, List, Any
-from dataclasses import dataclass
-from bs4 import BeautifulSoup, Tag
-from markdownify import markdownify as md
-import uuid
+from typing import Dict, List, Any, Sequence, Tuple, Union
+from bisect import bisect_left
+from collections import OrderedDict
+from hashlib import blake2b
+from html import escape
+import re
+import threading
+from lxml import html as lxml_html
+from markdownify import MarkdownConverter
 
+# Конвертер создается один раз: после __init__ он хранит только опции и безопасен для потоков
+_MD = MarkdownConverter(heading_style="ATX", bullets="-", strip=['script', 'style'])
 
-@dataclass
-class HtmlToMarkdownMapping:
-    """Структура для хранения связи HTML блока и строк Markdown"""
-    html_element_id: str
-    html_content: str
-    html_tag: str
-    markdown_line_start: int
-    markdown_line_end: int
-    markdown_content: str
+# Узел первого уровня: элемент/комментарий lxml или текст между элементами
+Node = Union[lxml_html.HtmlElement, str]
+
+# Строчные элементы: идущие подряд вместе с текстом они образуют один абзац Markdown
+_INLINE_TAGS = frozenset({
+    'a', 'abbr', 'acronym', 'b', 'bdi', 'bdo', 'big', 'br', 'cite', 'code', 'data',
+    'del', 'dfn', 'em', 'font', 'i', 'img', 'ins', 'kbd', 'label', 'mark', 'q', 's',
+    'samp', 'small', 'span', 'strike', 'strong', 'sub', 'sup', 'time', 'tt', 'u',
+    'var', 'wbr',
+})
+
+# lxml не принимает str с XML-декларацией, поэтому она отрезается перед разбором
+_XML_DECLARATION = re.compile(r'\s*<\?xml[^>]*>', re.IGNORECASE)
+
+# Полный документ начинается с doctype, <html>, <head> или <body> (теги html и head
+# необязательны), допускаются комментарии перед ними
+_FULL_DOCUMENT = re.compile(
+    r'\s*(?:<!--(?:[^-]|-(?!->))*-->\s*)*<(!doctype|html|head|body)(?=[\s>/])', re.IGNORECASE
+)
 
 
 class MappingService:
-    """Сервис для создания маппинга между HTML элементами и строками Markdown"""
+    """
+    Сервис для создания маппинга между HTML элементами и строками Markdown
+    
+    Между вызовами хранит только LRU кэш результатов (под блокировкой),
+    поэтому один экземпляр можно безопасно использовать для всех запросов.
+    """
+    
+    # Максимальное количество закэшированных результатов конвертации
+    CACHE_MAXSIZE = 128
+    
+    # Суммарный размер закэшированных результатов (в символах) и размер одного результата,
+    # больше которого результат не кэшируется: без этого крупные документы займут гигабайты
+    CACHE_MAX_CHARS = 32 * 1024 * 1024
+    CACHE_MAX_ENTRY_CHARS = 4 * 1024 * 1024
+    
+    # Максимальная длина текста ошибки в результате (исключение может содержать весь HTML)
+    ERROR_MAX_LENGTH = 500
     
     def __init__(self):
-        self.mappings: List[HtmlToMarkdownMapping] = []
+        # Ключ - дайджест HTML и флаг include_html_with_ids, значение - результат и его размер в символах
+        self._cache: "OrderedDict[Tuple[bytes, bool], Tuple[Dict[str, Any], int]]" = OrderedDict()
+        self._cache_chars = 0
+        self._cache_lock = threading.Lock()
     
-    def convert_with_mapping(self, html_text: str) -> Dict[str, Any]:
+    def convert_with_mapping(self, html_text: str, include_html_with_ids: bool = True) -> Dict[str, Any]:
         """
         Конвертирует HTML в Markdown с созданием маппинга
         
+        Результат для одинакового HTML берется из кэша: конвертация детерминирована.
+        
         Args:
             html_text: HTML текст для конвертации
+            include_html_with_ids: Собирать ли весь HTML документа с проставленными ID
             
         Returns:
             Dict с результатом конвертации и маппингом
         """
+        # Флаг хранится в ключе отдельно от дайджеста, чтобы не смешиваться с самим HTML
+        digest = blake2b(html_text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+        key = (digest, include_html_with_ids)
+        
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+        
+        if entry is not None:
+            result = entry[0]
+        else:
+            result = self._convert(html_text, include_html_with_ids)
+            # Ошибки не кэшируем
+            if result["status"] == "converted":
+                self._cache_put(key, result)
+        
+        # Отдаем копию, чтобы изменения у вызывающего кода не портили кэш
+        return {**result, "mappings": [dict(m) for m in result["mappings"]]}
+    
+    def _cache_put(self, key: Tuple[bytes, bool], result: Dict[str, Any]) -> None:
+        """Кладет результат в LRU кэш, вытесняя старые записи по количеству и суммарному размеру"""
+        size = len(result["markdown_result"]) + len(result.get("html_with_ids", ""))
+        size += sum(len(m["html_content"]) + len(m["markdown_content"]) for m in result["mappings"])
+        if size > self.CACHE_MAX_ENTRY_CHARS:
+            return
+        
+        with self._cache_lock:
+            # Тот же HTML мог параллельно сконвертировать другой поток
+            old_entry = self._cache.pop(key, None)
+            if old_entry is not None:
+                self._cache_chars -= old_entry[1]
+            
+            self._cache[key] = (result, size)
+            self._cache_chars += size
+            while len(self._cache) > self.CACHE_MAXSIZE or self._cache_chars > self.CACHE_MAX_CHARS:
+                _, (_, evicted_size) = self._cache.popitem(last=False)
+                self._cache_chars -= evicted_size
+    
+    def _convert(self, html_text: str, include_html_with_ids: bool) -> Dict[str, Any]:
+        """Выполняет конвертацию HTML в Markdown с маппингом без кэширования"""
         try:
-            # Парсим HTML
-            soup = BeautifulSoup(html_text, 'html.parser')
+            # XML-декларация возвращается в html_with_ids как есть
+            declaration = _XML_DECLARATION.match(html_text)
+            prefix = declaration.group(0) if declaration else ''
+            source = html_text[len(prefix):]
+            full_document = _FULL_DOCUMENT.match(source)
+            
+            # Разбираем HTML без построения дерева BeautifulSoup,
+            # узлы первого уровня - это содержимое body
+            root = self._parse(source, full_document is not None)
+            fragments = self._body_fragments(root)
             
             # Добавляем уникальные ID ко всем элементам
-            self._add_unique_ids(soup)
+            self._add_unique_ids(fragments)
             
-            # Конвертируем в Markdown
-            markdown_result = md(str(soup), 
-                               heading_style="ATX",
-                               bullets="-",
-                               strip=['script', 'style'])
+            # Сериализуем каждый узел один раз и переиспользуем результат
+            children, children_html = self._split_children(fragments)
             
-            # Создаем маппинг с оригинальным markdown
-            self._create_mapping(soup, markdown_result)
+            # Конвертируем в Markdown поэлементно, одновременно создавая маппинг
+            markdown_lines, mappings = self._create_mapping(children, children_html)
             
             # Добавляем нумерацию строк только в итоговый результат
-            numbered_markdown = self._add_line_numbers(markdown_result)
+            numbered_markdown = self._add_line_numbers(markdown_lines)
             
-            return {
+            result = {
                 "original_html_length": len(html_text),
                 "markdown_result": numbered_markdown.strip(),
-                "html_with_ids": str(soup),
-                "mappings": [self._mapping_to_dict(m) for m in self.mappings],
+                "mappings": mappings,
+                # Последние строки маппингов по возрастанию, для бинарного поиска в find_html_by_line
+                "line_ends": tuple(m["markdown_line_end"] for m in mappings),
                 "status": "converted"
             }
+            # Весь документ собираем в одну строку, только если он нужен клиенту
+            if include_html_with_ids:
+                if full_document:
+                    # Полный документ возвращается целиком: doctype, head, атрибуты html и body
+                    has_doctype = full_document.group(1).lower() == '!doctype'
+                    html_with_ids = self._serialize_document(root, has_doctype)
+                else:
+                    html_with_ids = ''.join(children_html)
+                result["html_with_ids"] = prefix + html_with_ids
+            return result
             
         except Exception as e:
             return {
                 "original_html_length": len(html_text),
                 "markdown_result": "",
                 "mappings": [],
+                "line_ends": (),
                 "status": "error",
-                "error": str(e)
+                "error": str(e)[:self.ERROR_MAX_LENGTH]
             }
     
-    def _add_line_numbers(self, markdown_text: str) -> str:
+    def _add_line_numbers(self, markdown_lines: List[str]) -> str:
         """Добавляет номера строк в формате [xxx] к каждой строке markdown"""
-        lines = markdown_text.split('\n')
-        numbered_lines = []
-        
-        for i, line in enumerate(lines, 1):
-            line_number = f"[{i:03d}]"
-            numbered_lines.append(f"{line_number} {line}")
-        
-        return '\n'.join(numbered_lines)
-    
-    def _add_unique_ids(self, soup: BeautifulSoup) -> None:
-        """Добавляет уникальные ID только к HTML элементам первого уровня"""
-        for element in soup.children:  # Находим только элементы первого уровня
-            if isinstance(element, Tag):
-                element['data-mapping-id'] = str(uuid.uuid4())
-    
-    def _create_mapping(self, soup: BeautifulSoup, markdown_text: str) -> None:
-        """Создает маппинг между HTML элементами и строками Markdown"""
-        self.mappings = []
-        markdown_lines = markdown_text.split('\n')
-        current_line = 0
-        
-        # Обходим только элементы первого уровня в порядке их появления
-        for element in soup.children:
-            if isinstance(element, Tag) and element.get('data-mapping-id'):
-                # Конвертируем отдельный элемент в markdown
-                element_markdown = md(str(element), 
-                                    heading_style="ATX",
-                                    bullets="-",
-                                    strip=['script', 'style']).strip()
-                
-                if element_markdown:
-                    # Находим этот контент в общем markdown
-                    line_start, line_end = self._find_content_lines(
-                        markdown_lines, element_markdown, current_line
-                    )
-                    
-                    if line_start != -1:
-                        mapping = HtmlToMarkdownMapping(
-                            html_element_id=element.get('data-mapping-id'),
-                            html_content=str(element),
-                            html_tag=element.name,
-                            markdown_line_start=line_start + 1,  # 1-based indexing
-                            markdown_line_end=line_end + 1,
-                            markdown_content=element_markdown
-                        )
-                        self.mappings.append(mapping)
-                        current_line = line_end
-    
-    def _find_content_lines(self, markdown_lines: List[str], content: str, start_from: int = 0) -> tuple:
-        """Находит диапазон строк, содержащих указанный контент"""
-        content_lines = content.split('\n')
-        
-        for i in range(start_from, len(markdown_lines)):
-            # Проверяем, начинается ли здесь искомый контент
-            match = True
-            for j, content_line in enumerate(content_lines):
-                if i + j >= len(markdown_lines) or markdown_lines[i + j].strip() != content_line.strip():
-                    match = False
-                    break
+        # Пустой Markdown нумеруется как одна пустая строка
+        lines = markdown_lines or ['']
+        # Список, а не генератор: str.join сначала сам собирает аргумент в список,
+        # так что генератор не экономит память и только добавляет накладные расходы
+        return '\n'.join([f"[{i:03d}] {line}" for i, line in enumerate(lines, 1)])
+    
+    def _parse(self, html_text: str, full_document: bool) -> lxml_html.HtmlElement:
+        """Разбирает HTML в документ, фрагмент - внутри <html><body>, как lxml.html.fragments_fromstring"""
+        if full_document:
+            root = lxml_html.document_fromstring(html_text)
+        else:
+            root = lxml_html.document_fromstring(f'<html><body>{html_text}</body></html>')
+        self._move_trailing_content(root)
+        return root
+    
+    def _move_trailing_content(self, root: lxml_html.HtmlElement) -> None:
+        """
+        Переносит содержимое после </html> в конец body, как это делают браузеры
+        
+        libxml2 складывает такой хвост (скрипты, футеры, текст) в дополнительный <html>:
+        в зависимости от версии вложенный в корень или соседний с ним. Без переноса
+        этот хвост не попал бы ни в Markdown, ни в html_with_ids.
+        """
+        extra = [child for child in root if child.tag == 'html']
+        extra.extend(sibling for sibling in root.itersiblings() if sibling.tag == 'html')
+        if not extra:
+            return
+        
+        nodes = []
+        for wrapper in extra:
+            nodes.extend(self._unwrap(wrapper))
+            if wrapper.tail and wrapper.getparent() is not None:
+                nodes.append(wrapper.tail)
+        for wrapper in extra:
+            if wrapper.getparent() is not None:
+                wrapper.getparent().remove(wrapper)
+        
+        body = root.find('body')
+        if body is None:
+            body = root.makeelement('body')
+            root.append(body)
+        for node in nodes:
+            if not isinstance(node, str):
+                body.append(node)
+            elif len(body):
+                body[-1].tail = (body[-1].tail or '') + node
+            else:
+                body.text = (body.text or '') + node
+    
+    def _unwrap(self, container: lxml_html.HtmlElement) -> List[Node]:
+        """Возвращает содержимое контейнера, раскрывая вложенные html/head/body"""
+        nodes = [container.text] if container.text else []
+        for child in container:
+            if child.tag in ('html', 'head', 'body'):
+                nodes.extend(self._unwrap(child))
+                if child.tail:
+                    nodes.append(child.tail)
+            else:
+                nodes.append(child)
+        return nodes
+    
+    def _body_fragments(self, root: lxml_html.HtmlElement) -> List[Node]:
+        """
+        Возвращает узлы первого уровня: текст в начале body и его дочерние элементы
+        
+        Документ без body (например, только с head) дает пустой список, а не ошибку.
+        """
+        body = root.find('body')
+        if body is None:
+            return []
+        fragments = [body.text] if body.text else []
+        fragments.extend(body)
+        return fragments
+    
+    def _serialize_document(self, root: lxml_html.HtmlElement, has_doctype: bool) -> str:
+        """Сериализует весь документ, включая комментарии вокруг <html>"""
+        tree = root.getroottree()
+        if has_doctype:
+            return lxml_html.tostring(tree, encoding='unicode')
+        # Без doctype в исходном HTML lxml подставил бы свой (HTML 4.0 Transitional)
+        html_text = lxml_html.tostring(tree, encoding='unicode', doctype='')
+        return html_text[1:] if html_text.startswith('\n') else html_text
+    
+    def _is_tag(self, node: Node) -> bool:
+        """Проверяет, что узел является HTML элементом (а не текстом или комментарием)"""
+        return not isinstance(node, str) and isinstance(node.tag, str)
+    
+    def _add_unique_ids(self, fragments: List[Node]) -> None:
+        """Добавляет ID вида m0, m1, ... к HTML элементам первого уровня (уникальны в рамках документа)"""
+        tags = (node for node in fragments if self._is_tag(node))
+        for i, element in enumerate(tags):
+            element.set('data-mapping-id', f"m{i}")
+    
+    def _split_children(self, fragments: List[Node]) -> Tuple[List[Node], List[str]]:
+        """
+        Раскладывает фрагменты на узлы первого уровня и их HTML
+        
+        lxml хранит текст после элемента в его tail, поэтому tail выносится
+        в отдельный текстовый узел. Текст экранируется так же, как при
+        сериализации документа.
+        """
+        children = []
+        children_html = []
+        for node in fragments:
+            if isinstance(node, str):
+                children.append(node)
+                children_html.append(escape(node, quote=False))
+                continue
             
-            if match:
-                return i, i + len(content_lines) - 1
-        
-        return -1, -1
-    
-    def _mapping_to_dict(self, mapping: HtmlToMarkdownMapping) -> Dict[str, Any]:
-        """Конвертирует маппинг в словарь для JSON ответа"""
-        return {
-            "html_element_id": mapping.html_element_id,
-            "html_tag": mapping.html_tag,
-            "html_content": mapping.html_content,
-            "markdown_line_start": mapping.markdown_line_start,
-            "markdown_line_end": mapping.markdown_line_end,
-            "markdown_content": mapping.markdown_content
-        }
-    
-    def find_html_by_line(self, line_number: int) -> Dict[str, Any]:
-        """Находит HTML блок по номеру строки Markdown"""
-        for mapping in self.mappings:
-            if mapping.markdown_line_start <= line_number <= mapping.markdown_line_end:
-                return self._mapping_to_dict(mapping)
-        return {}
\ No newline at end of file
+            children.append(node)
+            children_html.append(lxml_html.tostring(node, encoding='unicode', with_tail=False))
+            if node.tail:
+                children.append(node.tail)
+                children_html.append(escape(node.tail, quote=False))
+        return children, children_html
+    
+    def _group_children(self, children: List[Node],
+                        children_html: List[str]) -> List[Tuple[str, List[Tuple[Node, str]]]]:
+        """
+        Группирует узлы первого уровня в части итогового Markdown
+        
+        Подряд идущие текст и строчные элементы образуют одну часть (абзац),
+        подряд идущие <li> - один список, каждый блочный элемент - отдельную часть.
+        Пробельный текст и комментарии ничего не дают в Markdown: они остаются
+        только внутри абзаца, где пробелы между словами важны.
+        
+        Returns:
+            Список пар (вид части, узлы части вместе с их HTML)
+        """
+        groups = []
+        for node, node_html in zip(children, children_html):
+            if isinstance(node, str):
+                kind = 'inline' if node.strip() else None
+            elif self._is_tag(node):
+                if node.tag in _INLINE_TAGS:
+                    kind = 'inline'
+                elif node.tag == 'li':
+                    kind = 'li'
+                else:
+                    kind = 'block'
+            else:
+                kind = None
+            
+            last_kind = groups[-1][0] if groups else None
+            if kind is None:
+                if last_kind == 'inline':
+                    groups[-1][1].append((node, node_html))
+            elif kind != 'block' and kind == last_kind:
+                groups[-1][1].append((node, node_html))
+            else:
+                groups.append((kind, [(node, node_html)]))
+        return groups
+    
+    def _create_mapping(self, children: List[Node],
+                        children_html: List[str]) -> Tuple[List[str], List[Dict[str, Any]]]:
+        """
+        Конвертирует элементы первого уровня в Markdown и создает маппинг
+        
+        Каждая часть (см. _group_children) конвертируется ровно один раз, итоговый
+        Markdown собирается построчно из частей, разделенных пустой строкой.
+        Строчные элементы одного абзаца получают общий диапазон строк, пункты
+        списка - каждый свой.
+        
+        Args:
+            children: Узлы первого уровня в порядке их появления
+            children_html: Уже сериализованный HTML каждого узла
+            
+        Returns:
+            Строки итогового Markdown без нумерации и список маппингов
+        """
+        mappings = []
+        lines = []
+        
+        for kind, nodes in self._group_children(children, children_html):
+            # Пункты списка конвертируются по отдельности, чтобы у каждого был свой диапазон строк
+            items = [[node] for node in nodes] if kind == 'li' else [nodes]
+            # Пустая строка-разделитель ставится только между частями, внутри списка ее нет
+            needs_separator = bool(lines)
+            
+            for item in items:
+                item_markdown = _MD.convert(''.join(node_html for _, node_html in item)).strip()
+                
+                if not item_markdown:
+                    continue
+                
+                if needs_separator:
+                    lines.append('')
+                    needs_separator = False
+                line_start = len(lines) + 1  # 1-based indexing
+                lines.extend(item_markdown.split('\n'))
+                line_end = len(lines)
+                
+                for element, element_html in item:
+                    if not self._is_tag(element):
+                        continue
+                    # Маппинг сразу собирается в виде словаря для JSON ответа
+                    mappings.append({
+                        "html_element_id": element.get('data-mapping-id'),
+                        "html_tag": element.tag,
+                        "html_content": element_html,
+                        "markdown_line_start": line_start,
+                        "markdown_line_end": line_end,
+                        "markdown_content": item_markdown
+                    })
+        
+        return lines, mappings
+    
+    def find_html_by_line(self, mappings: List[Dict[str, Any]], line_ends: Sequence[int],
+                          line_number: int) -> Dict[str, Any]:
+        """Находит HTML блок по номеру строки Markdown по mappings и line_ends из convert_with_mapping"""
+        # Диапазоны строк идут по порядку, поэтому ищем бинарным поиском
+        idx = bisect_left(line_ends, line_number)
+        if idx < len(mappings) and mappings[idx]["markdown_line_start"] <= line_number:
+            return dict(mappings[idx])
+        return {}
@@ -1,5 +1,6 @@
 import uvicorn
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from app.controllers.converter_controller import router as converter_router
 
 
@@ -7,7 +8,8 @@ def create_app() -> FastAPI:
     app = FastAPI(
         title="Document Converter API",
         description="API для конвертации документов",
-        version="1.0.0"
+        version="1.0.0",
+        default_response_class=ORJSONResponse
     )
     
     app.include_router(converter_router, prefix="/api/v1")
@@ -0,0 +1,37 @@
+import pytest
+
+from app.services.mapping_service import MappingService
+
+
+@pytest.mark.parametrize("html_text", [
+    '<html><body><p>x</p></body></html><div>footer</div>',
+    '<!DOCTYPE html><html><body><p>x</p></body></html>footer',
+    '<html><head><title>T</title></head></html><p>footer</p>',
+])
+def test_content_after_closing_html_is_kept(html_text):
+    """Содержимое после </html> попадает и в Markdown, и в html_with_ids"""
+    result = MappingService().convert_with_mapping(html_text)
+
+    assert result["status"] == "converted"
+    assert "footer" in result["markdown_result"]
+    assert "footer" in result["html_with_ids"]
+
+
+def test_custom_element_named_like_html_is_a_fragment():
+    """Тег, имя которого только начинается с html, не делает фрагмент полным документом"""
+    result = MappingService().convert_with_mapping('<html-widget>hi</html-widget><p>x</p>')
+
+    assert not result["html_with_ids"].startswith('<html>')
+    assert [m["html_tag"] for m in result["mappings"]] == ["html-widget", "p"]
+
+
+@pytest.mark.parametrize("html_text", [
+    '<head><title>T</title><link rel="stylesheet" href="s.css"></head><body class="b"><p>x</p></body>',
+    '<body class="b"><p>x</p></body>',
+])
+def test_document_without_html_tag_keeps_head_and_body(html_text):
+    """Документ без необязательного <html> сохраняет head и атрибуты body, ID получает только контент"""
+    result = MappingService().convert_with_mapping(html_text)
+
+    assert '<body class="b">' in result["html_with_ids"]
+    assert [m["html_tag"] for m in result["mappings"]] == ["p"]